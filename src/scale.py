@@ -1,25 +1,36 @@
+from __future__ import annotations
+
 import dataclasses
+import enum
 import json
 import logging
 import os
-from contextlib import suppress
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from http import HTTPStatus
+from operator import itemgetter
 from pathlib import Path
-from time import sleep
-from typing import List, Literal
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Literal, Set, Tuple
 
 import kubernetes.client
+import orjson
 from azure.identity import DefaultAzureCredential
 from azure.mgmt.containerservice import ContainerServiceClient
-from azure.mgmt.containerservice.v2019_02_01.models import ManagedCluster, AgentPool
-from azure.cli.core import get_default_cli
 
 from colorlog import ColoredFormatter
 from kubernetes.client import CoreV1Api
+from kubernetes.client.exceptions import ApiException
 from kubernetes.config import load_kube_config
 
 from external.azure_identity_credential_adapter import AzureIdentityCredentialAdapter
 
+if TYPE_CHECKING:
+    # only used in annotations, importing the models of an API version at runtime is not needed
+    from azure.mgmt.containerservice.v2019_02_01.models import ManagedCluster, AgentPool
+
 logger = logging.getLogger(__name__)
 formatter = ColoredFormatter(
     '%(log_color)s%(levelname)s:%(reset)s %(message)s',
@@ -43,7 +54,22 @@ logger.setLevel(logging.INFO)
 # logging.getLogger("kubernetes").setLevel(logging.WARNING)
 
 
-@dataclasses.dataclass(frozen=True)
+class DownScalingStrategy(enum.Enum):
+    """
+    Which node of the agent pool, by order of the node names, is removed when scaling down.
+    """
+    LATEST = "latest"
+    OLDEST = "oldest"
+
+
+# picks the node to remove from the sorted nodes of the agent pool for each down scaling strategy
+NODE_PICKERS: Dict[DownScalingStrategy, Callable[[List[str]], str]] = {
+    DownScalingStrategy.LATEST: itemgetter(-1),
+    DownScalingStrategy.OLDEST: itemgetter(0),
+}
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class Config:
     """
     The configuration parameters for scaling. This is stored in a JSON file and loaded at runtime called config.json.
@@ -57,10 +83,21 @@ class Config:
     DELAY_BEFORE_SCALE_UP: int = 100
     DELAY_BEFORE_SCALE_DOWN: int = 300
     PERIODIC_CHECK_RATE: int = 1
+    CHECKS_BETWEEN_POOL_UPDATES: int = 5
+    CHECKS_BETWEEN_POOL_REFRESHES: int = 30
     TIMEOUT: int = 60
-    DEFAULT_DOWN_SCALING_STRATEGY: Literal["latest", "oldest"] = "latest"
+    DEFAULT_DOWN_SCALING_STRATEGY: DownScalingStrategy = DownScalingStrategy.LATEST
     DEFAULT_POD_PHASE: Literal["Queued", "Pending", "Running", "Succeeded", "Failed", "Unknown"] = "Queued"
 
+    def __post_init__(self):
+        # the strategy is read as a string from the config file, it is checked and converted once here instead of
+        # being compared as a string on every check
+        try:
+            strategy = DownScalingStrategy(self.DEFAULT_DOWN_SCALING_STRATEGY)
+        except ValueError:
+            raise ValueError(f"Unknown strategy {self.DEFAULT_DOWN_SCALING_STRATEGY}")
+        object.__setattr__(self, "DEFAULT_DOWN_SCALING_STRATEGY", strategy)
+
 
 def load_config_file() -> Config:
     """
@@ -77,7 +114,9 @@ def load_config_file() -> Config:
             run_config = json.load(f)
     except FileNotFoundError:
         with open(config_file, "w") as f:
-            json.dump({prop.name: getattr(Config, prop.name, None) for prop in dataclasses.fields(Config)}, f, indent=4)
+            # with slots the defaults are not class attributes, they are read from the fields
+            json.dump({prop.name: None if prop.default is dataclasses.MISSING else prop.default
+                       for prop in dataclasses.fields(Config)}, f, indent=4, default=lambda value: value.value)
         raise FileNotFoundError(
             f"Please fill in the config file generated in {config_file} "
             f"and run the script again")
@@ -85,53 +124,285 @@ def load_config_file() -> Config:
     return Config(**run_config)
 
 
-def get_number_of_pods_in_phase(k8s_client: CoreV1Api, namespace: str,
-                                pod_phase: str, ) -> int:
+def _pod_phase(pod: dict) -> str:
+    return pod["status"].get("phase")
+
+
+def _node_agent_pool(node: dict) -> str:
+    return node["metadata"].get("labels", {}).get("agentpool")
+
+
+def _iter_lines(response) -> Iterator[bytes]:
+    """
+    Split the streamed body of a watch response into lines, the apiserver writes one event per line and a chunk of the
+    stream can end in the middle of an event.
+
+    :param response: The urllib3 response of the watch request.
+    :return Iterator[bytes]: The non-empty lines of the body.
+    """
+    partial_line = b""
+    for chunk in response.stream(amt=None, decode_content=False):
+        lines = (partial_line + chunk).split(b"\n")
+        partial_line = lines.pop()
+        yield from filter(None, lines)
+    if partial_line:
+        yield partial_line
+
+
+def _watch_events(list_func: Callable, **kwargs) -> Iterator[dict]:
+    """
+    Watch the resources of a list function and yield the events with the object as a plain dict. Unlike
+    kubernetes.watch.Watch, the objects are not deserialized into client models, and the watch is not resumed once the
+    apiserver closes it.
+
+    :param list_func: Callable The list function of the resources to watch, e.g. CoreV1Api.list_namespaced_pod.
+    :return Iterator[dict]: The watch events.
+    """
+    response = list_func(watch=True, _preload_content=False, **kwargs)
+    try:
+        for line in _iter_lines(response):
+            event = orjson.loads(line)
+            if event["type"] == "ERROR":
+                status = event["object"]
+                raise ApiException(status=status.get("code"),
+                                   reason=f"{status.get('reason')}: {status.get('message')}")
+            yield event
+    finally:
+        response.close()
+        response.release_conn()
+
+
+# the apiserver ends the cache watches after WATCH_TIMEOUT_SECONDS and they are started again, the client gives up on a
+# watch that has not ended after the extra margin, so a connection that died silently cannot stall the cache or a drain
+WATCH_TIMEOUT_SECONDS = 300
+WATCH_TIMEOUT_MARGIN_SECONDS = 30
+
+
+class _ResourceStore:
+    """
+    The value extracted from each cached resource, by resource name.
+    """
+
+    def __init__(self):
+        self._values: Dict[str, str] = {}
+
+    def replace(self, values: Iterable[Tuple[str, str]]) -> None:
+        self._values = {}
+        for name, value in values:
+            self.set(name, value)
+
+    def set(self, name: str, value: str) -> None:
+        self._values[name] = value
+
+    def remove(self, name: str) -> None:
+        self._values.pop(name, None)
+
+
+class _IndexedStore(_ResourceStore):
+    """
+    A store that also indexes the resource names by value, so all resources with a given value are found without
+    scanning the store.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._names_by_value: Dict[str, Set[str]] = {}
+
+    def replace(self, values: Iterable[Tuple[str, str]]) -> None:
+        self._names_by_value = {}
+        super().replace(values)
+
+    def set(self, name: str, value: str) -> None:
+        self.remove(name)
+        super().set(name, value)
+        self._names_by_value.setdefault(value, set()).add(name)
+
+    def remove(self, name: str) -> None:
+        value = self._values.pop(name, None)
+        names = self._names_by_value.get(value)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del self._names_by_value[value]
+
+    def names(self, value: str) -> Set[str]:
+        return self._names_by_value.get(value, set())
+
+
+class _CountedStore(_ResourceStore):
+    """
+    A store that also counts the resources by value, so the number of resources with a given value is read without
+    scanning the store.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._counts: Counter[str] = Counter()
+
+    def replace(self, values: Iterable[Tuple[str, str]]) -> None:
+        self._counts = Counter()
+        super().replace(values)
+
+    def set(self, name: str, value: str) -> None:
+        self.remove(name)
+        super().set(name, value)
+        self._counts[value] += 1
+
+    def remove(self, name: str) -> None:
+        if name in self._values:
+            self._counts[self._values.pop(name)] -= 1
+
+    def count(self, value: str) -> int:
+        return self._counts[value]
+
+
+class ClusterCache:
+    """
+    In-memory view of the pods in a namespace and the nodes of an agent pool. The state is listed once and then kept in
+    sync by watching the Kubernetes API in background threads, so reading it does not cost an API call.
+    """
+
+    def __init__(self, k8s_client: CoreV1Api, namespace: str, agent_pool_name: str):
+        """
+        :param k8s_client: CoreV1Api The Kubernetes client.
+        :param namespace: str The namespace of the pods to keep track of.
+        :param agent_pool_name: str The name of the agent pool of the nodes to keep track of.
+        """
+        self._k8s_client = k8s_client
+        self._namespace = namespace
+        self._agent_pool_name = agent_pool_name
+        self._lock = threading.Lock()
+        self._pod_phases = _CountedStore()
+        self._node_pools = _IndexedStore()
+
+    def start(self) -> None:
+        """
+        List the pods and nodes and start the background threads watching them for changes. The pods and nodes are
+        independent, so they are listed concurrently.
+        """
+        resources = self._resources()
+        with ThreadPoolExecutor(max_workers=len(resources)) as executor:
+            lists = [executor.submit(self._list, list_func, store, extract, **kwargs)
+                     for list_func, store, extract, kwargs in resources]
+        for (list_func, store, extract, kwargs), listed in zip(resources, lists):
+            resource_version = listed.result()
+            threading.Thread(target=self._watch, args=(list_func, store, extract, resource_version), kwargs=kwargs,
+                             daemon=True).start()
+
+    def count_pods_in_phase(self, pod_phase: str) -> int:
+        """
+        :param pod_phase: str The pod phase to count.
+        :return int: The number of cached pods in the specified phase.
+        """
+        with self._lock:
+            return self._pod_phases.count(pod_phase)
+
+    def nodes_in_pool(self, agent_pool_name: str) -> List[str]:
+        """
+        :param agent_pool_name: str The name of the agent pool.
+        :return List[str]: The sorted names of the cached nodes in the agent pool.
+        """
+        with self._lock:
+            return sorted(self._node_pools.names(agent_pool_name))
+
+    def _resources(self) -> List[tuple]:
+        return [
+            (self._k8s_client.list_namespaced_pod, self._pod_phases, _pod_phase, {"namespace": self._namespace}),
+            (self._k8s_client.list_node, self._node_pools, _node_agent_pool,
+             {"label_selector": f"agentpool={self._agent_pool_name}"}),
+        ]
+
+    def _list(self, list_func: Callable, store: _ResourceStore, extract: Callable[[dict], Any], **kwargs) -> str:
+        """
+        Replace the content of the store with a fresh list served from the apiserver watch cache.
+
+        :return str: The resource version to start watching from.
+        """
+        response = list_func(watch=False, resource_version="0", _preload_content=False, **kwargs)
+        resource_list = orjson.loads(response.data)
+        with self._lock:
+            store.replace((item["metadata"]["name"], extract(item)) for item in resource_list["items"])
+        return resource_list["metadata"]["resourceVersion"]
+
+    def _watch(self, list_func: Callable, store: _ResourceStore, extract: Callable[[dict], Any],
+               resource_version: str, **kwargs) -> None:
+        """
+        Apply the watch events to the store for as long as the process runs. Bookmark events only move the resource
+        version forward, and the state is listed again when the resource version to resume from is gone.
+        """
+        needs_list = False
+        while True:
+            try:
+                # listing again is part of the retried body, a failing list is retried instead of ending the thread
+                if needs_list:
+                    resource_version = self._list(list_func, store, extract, **kwargs)
+                    needs_list = False
+                for event in _watch_events(list_func, resource_version=resource_version, allow_watch_bookmarks=True,
+                                           timeout_seconds=WATCH_TIMEOUT_SECONDS,
+                                           _request_timeout=WATCH_TIMEOUT_SECONDS + WATCH_TIMEOUT_MARGIN_SECONDS,
+                                           **kwargs):
+                    item = event["object"]
+                    self._apply_event(store, extract, event["type"], item)
+                    resource_version = item["metadata"]["resourceVersion"]
+            except ApiException as e:
+                if e.status == HTTPStatus.GONE:
+                    logger.info(f"Resource version {resource_version} is gone, listing again")
+                    needs_list = True
+                    continue
+                logger.exception(e)
+                sleep(1)
+            except Exception as e:
+                logger.exception(e)
+                sleep(1)
+
+    def _apply_event(self, store: _ResourceStore, extract: Callable[[dict], Any], event_type: str,
+                     item: dict) -> None:
+        with self._lock:
+            if event_type == "DELETED":
+                store.remove(item["metadata"]["name"])
+            elif event_type in ("ADDED", "MODIFIED"):
+                store.set(item["metadata"]["name"], extract(item))
+
+
+def get_number_of_pods_in_phase(cache: ClusterCache, pod_phase: str) -> int:
     """
     Get the number of pods in the specified phase.
 
-    :param k8s_client:
-    :param namespace:
-    :param pod_phase:
+    :param cache: ClusterCache The cached state of the cluster.
+    :param pod_phase: str The pod phase to count.
     :return int: The number of pods in the specified phase.
     """
-    pods = k8s_client.list_namespaced_pod(namespace=namespace, watch=False).items
-    return len([pod for pod in pods if pod.status.phase == pod_phase])
+    return cache.count_pods_in_phase(pod_phase)
 
 
-def get_nodes_in_pool(k8s_client: CoreV1Api, agent_pool: AgentPool) -> List[str]:
+def get_nodes_in_pool(cache: ClusterCache, agent_pool: AgentPool) -> List[str]:
     """
     Get the list of nodes in the agent pool.
 
-    :param k8s_client: CoreV1Api: The Kubernetes client.
+    :param cache: ClusterCache The cached state of the cluster.
     :param agent_pool: AgentPool: The AKS agent pool to scale.
-    :return List[str]: The list of nodes in the agent pool.
+    :return List[str]: The sorted list of nodes in the agent pool.
     """
-    nodes = k8s_client.list_node(watch=False).items
-    nodes_in_pool = sorted(
-        [node.metadata.name for node in nodes if node.metadata.labels.get("agentpool") == agent_pool.name])
-    return list(set(nodes_in_pool))
+    return cache.nodes_in_pool(agent_pool.name)
 
 
-def aks_scaler(client: ContainerServiceClient, k8s_client: CoreV1Api, agent_pool: AgentPool,
-               cluster: ManagedCluster,
+def aks_scaler(k8s_client: CoreV1Api, cache: ClusterCache, agent_pool: AgentPool,
                last_scaling_event_time: datetime,
                config_params: Config) -> datetime:
     """
-    Scales the AKS agent pool based on the number of queued pods and the configured scaling parameters.
+    Scales the AKS agent pool based on the number of queued pods and the configured scaling parameters. The new pool
+    size is set on agent_pool.count, sending it to AKS is left to the caller, see update_agent_pool.
 
-    :param client: ContainerServiceClient The Azure Container Service client.
     :param k8s_client: CoreV1Api The Kubernetes client.
+    :param cache: ClusterCache The cached pods and nodes of the cluster.
     :param agent_pool: AgentPool The AKS agent pool to scale.
-    :param cluster: ManagedCluster The AKS cluster containing the agent pool.
     :param last_scaling_event_time: datetime The time of the last scaling event.
     :param config_params: Config The configuration parameters for scaling.
 
     :return datetime: The time of the scaling event, or the time of the last scaling event if no scaling occurred.
     """
-    scaling_start_time = datetime.now(tz=timezone.utc)
+    now = datetime.now(tz=timezone.utc)
     scaling_event_time: datetime | None = None
-    post_scale_pool_size = agent_pool.count
 
     # check if the autoscaling is enabled on the agent pool
     if agent_pool.enable_auto_scaling:
@@ -143,117 +414,236 @@ def aks_scaler(client: ContainerServiceClient, k8s_client: CoreV1Api, agent_pool
         logger.warning("Agent pool is not in a state that can be scaled")
         return last_scaling_event_time
 
-    nodes_pre_scale = get_nodes_in_pool(k8s_client=k8s_client, agent_pool=agent_pool)
+    nodes_pre_scale = get_nodes_in_pool(cache=cache, agent_pool=agent_pool)
     pre_scale_pool_size = agent_pool.count
-    queued_pods = get_number_of_pods_in_phase(k8s_client=k8s_client, namespace=config_params.DEFAULT_NAMESPACE,
-                                              pod_phase=config_params.DEFAULT_POD_PHASE)
+    queued_pods = get_number_of_pods_in_phase(cache=cache, pod_phase=config_params.DEFAULT_POD_PHASE)
+    seconds_since_last_scaling = (now - last_scaling_event_time).total_seconds()
 
     if queued_pods > config_params.MAX_POD_QUEUE:
-        if (last_scaling_event_time - datetime.now(tz=timezone.utc)).seconds > config_params.DELAY_BEFORE_SCALE_UP:
+        if seconds_since_last_scaling > config_params.DELAY_BEFORE_SCALE_UP:
             agent_pool.count += 1
             logger.info(f"Scaling up the agent pool from {pre_scale_pool_size} to {agent_pool.count}")
-            post_scale_pool_size = agent_pool.count
-            scaling_event_time = datetime.now(tz=timezone.utc)
+            scaling_event_time = now
     elif queued_pods < config_params.MAX_POD_QUEUE:
-        if config_params.DEFAULT_DOWN_SCALING_STRATEGY == "latest":
-            with suppress(IndexError):
-                node_to_remove = nodes_pre_scale[-1]
-        elif config_params.DEFAULT_DOWN_SCALING_STRATEGY == "oldest":
-            with suppress(IndexError):
-                node_to_remove = nodes_pre_scale[0]
-        else:
-            raise ValueError("Unknown strategy")
+        node_to_remove = NODE_PICKERS[config_params.DEFAULT_DOWN_SCALING_STRATEGY](nodes_pre_scale) \
+            if nodes_pre_scale else None
 
         # cordon the node to be removed
-        if node_to_remove is not None and (last_scaling_event_time - datetime.now(tz=timezone.utc)).seconds > \
-                config_params.DELAY_BEFORE_SCALE_DOWN:
+        if node_to_remove is not None and seconds_since_last_scaling > config_params.DELAY_BEFORE_SCALE_DOWN:
             logger.info(f"Cordoned node {node_to_remove}, wait for all running pods to finish")
             k8s_client.patch_node(node_to_remove, {"spec": {"unschedulable": True}})
-            while len(get_pods_running_on_node(k8s_client, node_to_remove)) > 0 and (
-                    datetime.now(tz=timezone.utc) - scaling_start_time).seconds < config_params.TIMEOUT:
-                logger.info(f"Waiting for pods to be evicted from {node_to_remove}")
-                logger.info(get_pods_running_on_node(k8s_client, node_to_remove))
-                sleep(1)
-            if (datetime.now(tz=timezone.utc) - scaling_start_time).seconds < config_params.TIMEOUT:
+            remaining_pods = wait_for_pods_to_leave_node(k8s_client, node_to_remove, timeout=config_params.TIMEOUT)
+            if remaining_pods:
                 logger.warning(f"Timeout is reached, Node {node_to_remove} is being deleted")
             k8s_client.delete_node(node_to_remove)
 
-            if agent_pool.count > 1:
-                agent_pool.count -= 1
-            else:
-                aks_scale_pool_to_0(agent_pool=agent_pool, cluster=cluster,
-                                    resource_group=config_params.AZURE_RESOURCE_GROUP_NAME)
+            agent_pool.count = max(agent_pool.count - 1, 0)
 
             logger.info(
                 f"Scaling down the agent pool from {pre_scale_pool_size} to {agent_pool.count} the node "
                 f"is already deleted, just syncing the pool size")
-            post_scale_pool_size = agent_pool.count
+            # draining the node takes up to TIMEOUT, so the clock is read again once it is done
             scaling_event_time = datetime.now(tz=timezone.utc)
 
-    if post_scale_pool_size != pre_scale_pool_size:
-        client.agent_pools.create_or_update(resource_group_name=config_params.AZURE_RESOURCE_GROUP_NAME,
-                                            managed_cluster_name=cluster.name, agent_pool_name=agent_pool.name,
-                                            parameters=agent_pool)
-
     if scaling_event_time is not None:
         return scaling_event_time
     else:
         return last_scaling_event_time
 
 
+def update_agent_pool(client: ContainerServiceClient, agent_pool: AgentPool, cluster: ManagedCluster,
+                      resource_group: str) -> AgentPool:
+    """
+    Send the agent pool to AKS without waiting for the update to complete, the pool reports a provisioning state
+    other than Succeeded until it does. A count of 0 is sent through aks_scale_pool_to_0.
+
+    :param client: ContainerServiceClient The Azure Container Service client.
+    :param agent_pool: AgentPool The AKS agent pool to update.
+    :param cluster: ManagedCluster The AKS cluster containing the agent pool.
+    :param resource_group: str The name of the resource group containing the agent pool.
+    :return AgentPool: The agent pool as accepted by AKS.
+    """
+    if agent_pool.count == 0:
+        aks_scale_pool_to_0(agent_pool=agent_pool, cluster=cluster, resource_group=resource_group)
+        return client.agent_pools.get(resource_group_name=resource_group, managed_cluster_name=cluster.name,
+                                      agent_pool_name=agent_pool.name)
+    return client.agent_pools.create_or_update(resource_group_name=resource_group, managed_cluster_name=cluster.name,
+                                               agent_pool_name=agent_pool.name, parameters=agent_pool,
+                                               polling=False).result()
+
+
 def aks_scale_pool_to_0(agent_pool: AgentPool, cluster: ManagedCluster, resource_group: str) -> None:
     """
-    Scale the agent pool to 0 nodes, this works around the issue with API not doing scaling down to 0
+    Scale the agent pool to 0 nodes, this works around the AgentPool model of the SDK (API version 2019-04-01)
+    rejecting a count below 1 before the request is sent.
 
     :param agent_pool: AgentPool The AKS agent pool to scale.
     :param cluster: ManagedCluster The AKS cluster containing the agent pool.
     :param resource_group: str The name of the resource group containing the agent pool.
     :return: None
     """
+    # the Azure CLI is slow to import and only needed for the last node of the pool
+    from azure.cli.core import get_default_cli
+
     cli = get_default_cli()
-    cli.invoke(["aks", "nodepool", "scale", "--resource-group", resource_group, "--cluster-name", cluster.name,
-                "--name", agent_pool.name, "--node-count", "0", "--no-wait"])
+    exit_code = cli.invoke(["aks", "nodepool", "scale", "--resource-group", resource_group, "--cluster-name",
+                            cluster.name, "--name", agent_pool.name, "--node-count", "0", "--no-wait"])
+    if exit_code != 0:
+        raise RuntimeError(f"Scaling the agent pool {agent_pool.name} to 0 failed with exit code {exit_code}")
+
 
+class AgentPoolSync:
+    """
+    The agent pool as seen by the scaler between checks. The pool is only fetched again from AKS periodically, while an
+    update is in progress or after an error, and the size changes of several checks are sent to AKS as one update.
+    """
 
-def get_pods_running_on_node(k8s_client: CoreV1Api, node_to_remove: str) -> list[str]:
+    def __init__(self, client: ContainerServiceClient, cluster: ManagedCluster, config_params: Config):
+        """
+        :param client: ContainerServiceClient The Azure Container Service client.
+        :param cluster: ManagedCluster The AKS cluster containing the agent pool.
+        :param config_params: Config The configuration parameters for scaling.
+        """
+        self._client = client
+        self._cluster = cluster
+        self._resource_group = config_params.AZURE_RESOURCE_GROUP_NAME
+        self._agent_pool_name = config_params.AGENT_POOL_NAME
+        self._update_interval = config_params.PERIODIC_CHECK_RATE * config_params.CHECKS_BETWEEN_POOL_UPDATES
+        self._checks_between_refreshes = config_params.CHECKS_BETWEEN_POOL_REFRESHES
+        self._agent_pool: AgentPool | None = None
+        self._checks_since_refresh = 0
+        # the count last reported by AKS, and the count set by the checks that is not sent yet
+        self._pool_count: int | None = None
+        self._pending_count: int | None = None
+        self._next_update_time = float("-inf")
+
+    def get(self) -> AgentPool:
+        """
+        Get the agent pool for a check, with the size changes that are not sent to AKS yet applied to its count.
+
+        :return AgentPool: The agent pool to scale.
+        """
+        if self._agent_pool is None or self._agent_pool.provisioning_state != "Succeeded" or \
+                self._checks_since_refresh >= self._checks_between_refreshes:
+            self._agent_pool = self._client.agent_pools.get(resource_group_name=self._resource_group,
+                                                            managed_cluster_name=self._cluster.name,
+                                                            agent_pool_name=self._agent_pool_name)
+            self._pool_count = self._agent_pool.count
+            self._checks_since_refresh = 0
+        self._checks_since_refresh += 1
+        if self._pending_count is not None:
+            self._agent_pool.count = self._pending_count
+        return self._agent_pool
+
+    def flush(self, now: float) -> None:
+        """
+        Record the count set by the check and send it to AKS if the update interval has passed since the last update.
+
+        :param now: float The monotonic time of the check.
+        """
+        count = self._agent_pool.count
+        self._pending_count = count if count != self._pool_count else None
+        if self._pending_count is None or now < self._next_update_time:
+            return
+        # the next update time is moved before sending, so a failing update is retried once per interval and not on
+        # every check
+        self._next_update_time = now + self._update_interval
+        self._agent_pool = update_agent_pool(client=self._client, agent_pool=self._agent_pool, cluster=self._cluster,
+                                             resource_group=self._resource_group)
+        self._pool_count = self._agent_pool.count
+        self._pending_count = None
+
+    def invalidate(self) -> None:
+        """
+        Fetch the agent pool again on the next check, the count not sent to AKS yet is kept.
+        """
+        self._agent_pool = None
+
+
+def wait_for_pods_to_leave_node(k8s_client: CoreV1Api, node_to_remove: str, timeout: float) -> list[str]:
     """
-    Get all the pods running on the node to be removed to exclude daemonsets.
+    Wait for all the pods running on the node to be removed to finish, excluding daemonsets. The pods are listed once
+    and then followed with a watch instead of listing them again until they are gone, the watch is opened again from
+    the last seen resource version when the apiserver closes it before the timeout.
 
     :param k8s_client: CoreV1Api The Kubernetes client.
     :param node_to_remove: str The name of the node to be removed.
-    :return list[str]: The list of pods running on the node to be removed.
+    :param timeout: float The maximum number of seconds to wait.
+    :return list[str]: The pods still running on the node when the timeout is reached, empty if the node is drained.
     """
-    pods_running_on_node = k8s_client.list_namespaced_pod(namespace="monitoring", watch=False,
-                                                          label_selector="kubernetes.io/created-by!=DaemonSet",
-                                                          field_selector=f"spec.nodeName={node_to_remove}"
-                                                                         f",status.phase=Running")
-    return [pod.metadata.name for pod in pods_running_on_node.items]
+    selectors = dict(namespace="monitoring", label_selector="kubernetes.io/created-by!=DaemonSet",
+                     field_selector=f"spec.nodeName={node_to_remove},status.phase=Running")
+    deadline = monotonic() + timeout
+    resource_version: str | None = None
+    while True:
+        if resource_version is None:
+            response = k8s_client.list_namespaced_pod(watch=False, resource_version="0", _preload_content=False,
+                                                      **selectors)
+            pods_running_on_node = orjson.loads(response.data)
+            pods = {pod["metadata"]["name"] for pod in pods_running_on_node["items"]}
+            resource_version = pods_running_on_node["metadata"]["resourceVersion"]
+            if pods:
+                logger.info(f"Waiting for pods to be evicted from {node_to_remove}: {sorted(pods)}")
+        timeout_seconds = int(deadline - monotonic())
+        if not pods or timeout_seconds <= 0:
+            return sorted(pods)
+        try:
+            for event in _watch_events(k8s_client.list_namespaced_pod, resource_version=resource_version,
+                                       timeout_seconds=timeout_seconds,
+                                       _request_timeout=timeout_seconds + WATCH_TIMEOUT_MARGIN_SECONDS, **selectors):
+                pod = event["object"]
+                if event["type"] == "DELETED" or _pod_phase(pod) != "Running":
+                    pods.discard(pod["metadata"]["name"])
+                else:
+                    pods.add(pod["metadata"]["name"])
+                resource_version = pod["metadata"]["resourceVersion"]
+                if not pods:
+                    break
+        except ApiException as e:
+            if e.status != HTTPStatus.GONE:
+                raise
+            logger.info(f"Watch of the pods on {node_to_remove} expired, listing them again")
+            resource_version = None
 
 
 def main():
     config_params = load_config_file()
     scaler_start_time = datetime.now(tz=timezone.utc)
     last_scaling_event_time = None
-    client = ContainerServiceClient(
-        credentials=AzureIdentityCredentialAdapter(DefaultAzureCredential()),
-        subscription_id=config_params.AZURE_SUBSCRIPTION_ID,
-    )
-    cluster = client.managed_clusters.get(resource_group_name=config_params.AZURE_RESOURCE_GROUP_NAME,
-                                          resource_name=config_params.AKS_CLUSTER_NAME)
-    load_kube_config()
-    k8s = kubernetes.client.CoreV1Api()
-    while True:
-        try:
-            agent_pool = client.agent_pools.get(resource_group_name=config_params.AZURE_RESOURCE_GROUP_NAME,
-                                                managed_cluster_name=cluster.name,
-                                                agent_pool_name=config_params.AGENT_POOL_NAME)
-            last_scaling_event_time = aks_scaler(client=client, k8s_client=k8s, agent_pool=agent_pool,
-                                                 cluster=cluster,
-                                                 last_scaling_event_time=last_scaling_event_time or scaler_start_time,
-                                                 config_params=config_params)
-        except Exception as e:
-            logger.exception(e)
-        sleep(config_params.PERIODIC_CHECK_RATE)
+    # entering the client turns on keep-alive, without it the ARM session is closed after every request and each call
+    # pays a new TCP and TLS handshake
+    with ContainerServiceClient(
+            credentials=AzureIdentityCredentialAdapter(DefaultAzureCredential()),
+            subscription_id=config_params.AZURE_SUBSCRIPTION_ID,
+    ) as client:
+        cluster = client.managed_clusters.get(resource_group_name=config_params.AZURE_RESOURCE_GROUP_NAME,
+                                              resource_name=config_params.AKS_CLUSTER_NAME)
+        load_kube_config()
+        k8s = kubernetes.client.CoreV1Api()
+        cache = ClusterCache(k8s_client=k8s, namespace=config_params.DEFAULT_NAMESPACE,
+                             agent_pool_name=config_params.AGENT_POOL_NAME)
+        cache.start()
+        agent_pool_sync = AgentPoolSync(client=client, cluster=cluster, config_params=config_params)
+        # checks start every PERIODIC_CHECK_RATE seconds, the time spent in a check is not added on top of the period
+        next_check_time = monotonic()
+        while True:
+            next_check_time += config_params.PERIODIC_CHECK_RATE
+            try:
+                agent_pool = agent_pool_sync.get()
+                last_scaling_event_time = aks_scaler(
+                    k8s_client=k8s, cache=cache, agent_pool=agent_pool,
+                    last_scaling_event_time=last_scaling_event_time or scaler_start_time, config_params=config_params)
+                agent_pool_sync.flush(now=monotonic())
+            except Exception as e:
+                logger.exception(e)
+                agent_pool_sync.invalidate()
+            delay = next_check_time - monotonic()
+            if delay > 0:
+                sleep(delay)
+            else:
+                # the check overran its period, e.g. while draining a node, start the next one right away and do not
+                # try to catch up on the missed ones
+                next_check_time = monotonic()
 
 
 if __name__ == "__main__":
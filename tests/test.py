@@ -1,9 +1,20 @@
+import dataclasses
+import itertools
+import json
+import sys
+from datetime import datetime, timedelta, timezone
+
 import pytest
-from unittest.mock import MagicMock
+import requests
+from unittest.mock import MagicMock, patch
 from kubernetes.client import CoreV1Api
+from kubernetes.client.exceptions import ApiException
+from msrest.exceptions import ValidationError
 from azure.mgmt.containerservice import ContainerServiceClient
-from azure.mgmt.containerservice.models import ManagedCluster, AgentPool
-from scale import get_number_of_pods_in_phase, get_nodes_in_pool, aks_scaler
+from azure.mgmt.containerservice.models import AgentPool
+from scale import Config, DownScalingStrategy, ClusterCache, get_number_of_pods_in_phase, get_nodes_in_pool, \
+    wait_for_pods_to_leave_node, update_agent_pool, aks_scaler, AgentPoolSync, \
+    _pod_phase, _node_agent_pool, _watch_events, WATCH_TIMEOUT_MARGIN_SECONDS
 
 @pytest.fixture
 def k8s_client():
@@ -14,33 +25,269 @@ def container_service_client():
     return MagicMock(spec=ContainerServiceClient)
 
 @pytest.fixture
-def agent_pool():
-    return AgentPool(name="pool1")
+def cache(k8s_client):
+    return ClusterCache(k8s_client, "default", "pool1")
 
-@pytest.fixture
-def cluster():
-    return ManagedCluster(id="/subscriptions/123/resourceGroups/rg1/providers/Microsoft.ContainerService/managedClusters/cluster1")
-
-def test_get_number_of_pods_in_phase(k8s_client):
-    k8s_client.list_namespaced_pod.return_value.items = [
-        MagicMock(status=MagicMock(phase="Running")),
-        MagicMock(status=MagicMock(phase="Pending")),
-        MagicMock(status=MagicMock(phase="Running")),
-        MagicMock(status=MagicMock(phase="Failed")),
+def list_response(*items):
+    return MagicMock(data=json.dumps({"metadata": {"resourceVersion": "1"}, "items": list(items)}).encode())
+
+def start_cache(cache):
+    with patch.object(ClusterCache, "_watch"):
+        cache.start()
+
+def test_get_number_of_pods_in_phase(k8s_client, cache):
+    k8s_client.list_namespaced_pod.return_value = list_response(
+        {"metadata": {"name": "pod1"}, "status": {"phase": "Running"}},
+        {"metadata": {"name": "pod2"}, "status": {"phase": "Pending"}},
+        {"metadata": {"name": "pod3"}, "status": {"phase": "Running"}},
+        {"metadata": {"name": "pod4"}, "status": {"phase": "Failed"}},
+    )
+    k8s_client.list_node.return_value = list_response()
+    start_cache(cache)
+    k8s_client.list_namespaced_pod.assert_called_once_with(watch=False, resource_version="0",
+                                                           _preload_content=False, namespace="default")
+    assert get_number_of_pods_in_phase(cache, "Running") == 2
+    store, extract = cache._pod_phases, _pod_phase
+    cache._apply_event(store, extract, "MODIFIED", {"metadata": {"name": "pod2"}, "status": {"phase": "Running"}})
+    cache._apply_event(store, extract, "DELETED", {"metadata": {"name": "pod1"}, "status": {"phase": "Running"}})
+    assert get_number_of_pods_in_phase(cache, "Running") == 2
+    assert get_number_of_pods_in_phase(cache, "Pending") == 0
+    cache._apply_event(store, extract, "MODIFIED", {"metadata": {"name": "pod3"}, "status": {"phase": "Succeeded"}})
+    cache._apply_event(store, extract, "DELETED", {"metadata": {"name": "pod5"}, "status": {"phase": "Running"}})
+    assert get_number_of_pods_in_phase(cache, "Running") == 1
+    assert get_number_of_pods_in_phase(cache, "Succeeded") == 1
+
+class StopWatching(BaseException):
+    pass
+
+def test_watch_retries_failed_list(k8s_client, cache):
+    pod = {"metadata": {"name": "pod1", "resourceVersion": "3"}, "status": {"phase": "Pending"}}
+    watches = [ApiException(status=410), iter([{"type": "ADDED", "object": pod}]), StopWatching()]
+    lists = [ApiException(status=503), "2"]
+
+    def watch_events(*args, **kwargs):
+        watch = watches.pop(0)
+        if isinstance(watch, BaseException):
+            raise watch
+        return watch
+
+    def list_resources(*args, **kwargs):
+        listed = lists.pop(0)
+        if isinstance(listed, BaseException):
+            raise listed
+        return listed
+
+    with patch("scale._watch_events", side_effect=watch_events) as watch_events_mock, \
+            patch.object(cache, "_list", side_effect=list_resources), patch("scale.sleep"):
+        with pytest.raises(StopWatching):
+            cache._watch(k8s_client.list_namespaced_pod, cache._pod_phases, _pod_phase, "1", namespace="default")
+    assert [call.kwargs["resource_version"] for call in watch_events_mock.call_args_list] == ["1", "2", "3"]
+    watch_kwargs = watch_events_mock.call_args.kwargs
+    assert watch_kwargs["_request_timeout"] > watch_kwargs["timeout_seconds"]
+    assert get_number_of_pods_in_phase(cache, "Pending") == 1
+
+def test_get_nodes_in_pool(k8s_client, cache):
+    agent_pool = MagicMock()
+    agent_pool.name = "pool1"
+    k8s_client.list_namespaced_pod.return_value = list_response()
+    k8s_client.list_node.return_value = list_response(
+        {"metadata": {"name": "node3", "labels": {"agentpool": "pool1"}}},
+        {"metadata": {"name": "node1", "labels": {"agentpool": "pool1"}}},
+    )
+    start_cache(cache)
+    k8s_client.list_node.assert_called_once_with(watch=False, resource_version="0", _preload_content=False,
+                                                 label_selector="agentpool=pool1")
+    assert get_nodes_in_pool(cache, agent_pool) == ["node1", "node3"]
+    store, extract = cache._node_pools, _node_agent_pool
+    cache._apply_event(store, extract, "MODIFIED", {"metadata": {"name": "node1", "labels": {"agentpool": "pool2"}}})
+    cache._apply_event(store, extract, "ADDED", {"metadata": {"name": "node4", "labels": {"agentpool": "pool1"}}})
+    cache._apply_event(store, extract, "DELETED", {"metadata": {"name": "node3", "labels": {"agentpool": "pool1"}}})
+    assert get_nodes_in_pool(cache, agent_pool) == ["node4"]
+
+def running_pod(name, resource_version="1"):
+    return {"metadata": {"name": name, "resourceVersion": resource_version}, "status": {"phase": "Running"}}
+
+def test_wait_for_pods_to_leave_node(k8s_client):
+    k8s_client.list_namespaced_pod.return_value = list_response(running_pod("pod1"), running_pod("pod2"))
+    events = [{"type": "MODIFIED", "object": {"metadata": {"name": "pod1", "resourceVersion": "2"},
+                                              "status": {"phase": "Succeeded"}}},
+              {"type": "DELETED", "object": running_pod("pod2", resource_version="3")}]
+    with patch("scale.monotonic", return_value=0), \
+            patch("scale._watch_events", return_value=iter(events)) as watch_events:
+        assert wait_for_pods_to_leave_node(k8s_client, "node1", timeout=60) == []
+    watch_events.assert_called_once()
+    assert watch_events.call_args.kwargs["timeout_seconds"] == 60
+    assert watch_events.call_args.kwargs["_request_timeout"] == 60 + WATCH_TIMEOUT_MARGIN_SECONDS
+    assert watch_events.call_args.kwargs["resource_version"] == "1"
+
+def test_wait_for_pods_to_leave_node_timeout(k8s_client):
+    k8s_client.list_namespaced_pod.return_value = list_response(running_pod("pod1"), running_pod("pod2"))
+    events = [iter([{"type": "DELETED", "object": running_pod("pod2", resource_version="2")}]), iter([])]
+    # the first watch is closed by the apiserver 20 seconds in, the second one runs until the deadline
+    with patch("scale.monotonic", side_effect=[0, 0, 20, 60]), \
+            patch("scale._watch_events", side_effect=events) as watch_events:
+        assert wait_for_pods_to_leave_node(k8s_client, "node1", timeout=60) == ["pod1"]
+    assert [call.kwargs["timeout_seconds"] for call in watch_events.call_args_list] == [60, 40]
+    assert [call.kwargs["resource_version"] for call in watch_events.call_args_list] == ["1", "2"]
+    k8s_client.list_namespaced_pod.assert_called_once()
+
+def test_wait_for_pods_to_leave_node_relists_expired_watch(k8s_client):
+    k8s_client.list_namespaced_pod.side_effect = [list_response(running_pod("pod1")), list_response()]
+    with patch("scale.monotonic", return_value=0), \
+            patch("scale._watch_events", side_effect=ApiException(status=410)) as watch_events:
+        assert wait_for_pods_to_leave_node(k8s_client, "node1", timeout=60) == []
+    watch_events.assert_called_once()
+    assert k8s_client.list_namespaced_pod.call_count == 2
+
+def test_watch_events(k8s_client):
+    k8s_client.list_node.return_value.stream.return_value = [
+        b'{"type": "ADDED", "object": {"metadata": {"name": "node1"}}}\n{"type": "DEL',
+        b'ETED", "object": {"metadata": {"name": "node1"}}}\n',
+        b'{"type": "ERROR", "object": {"code": 410, "reason": "Gone", "message": "too old resource version"}}\n',
     ]
-    assert get_number_of_pods_in_phase(k8s_client, "default", "Running") == 2
+    events = _watch_events(k8s_client.list_node, resource_version="1")
+    assert [event["type"] for event in itertools.islice(events, 2)] == ["ADDED", "DELETED"]
+    with pytest.raises(ApiException) as e:
+        next(events)
+    assert e.value.status == 410
+    k8s_client.list_node.assert_called_once_with(watch=True, _preload_content=False, resource_version="1")
+    k8s_client.list_node.return_value.release_conn.assert_called_once()
 
-def test_get_nodes_in_pool(k8s_client, agent_pool):
-    k8s_client.list_node.return_value.items = [
-        MagicMock(metadata=MagicMock(name="node1", labels={"agentpool": "pool1"})),
-        MagicMock(metadata=MagicMock(name="node2", labels={"agentpool": "pool2"})),
-        MagicMock(metadata=MagicMock(name="node3", labels={"agentpool": "pool1"})),
+def test_watch_events_error_without_reason(k8s_client):
+    k8s_client.list_node.return_value.stream.return_value = [
+        b'{"type": "ERROR", "object": {"code": 410, "message": "too old resource version"}}',
     ]
-    assert get_nodes_in_pool(k8s_client, agent_pool) == ["node1", "node3"]
-
-def test_aks_scaler(container_service_client, k8s_client, agent_pool, cluster):
-    last_scaling_event_time = None
-    config_params = MagicMock()
-    aks_scaler(container_service_client, k8s_client, agent_pool, cluster, last_scaling_event_time, config_params)
-    container_service_client.container_services.get.assert_called_once_with(
-        resource_group_name="rg1", container_service_name="cluster1")
\ No newline at end of file
+    with pytest.raises(ApiException) as e:
+        next(_watch_events(k8s_client.list_node, resource_version="1"))
+    assert e.value.status == 410
+
+def test_update_agent_pool(container_service_client):
+    agent_pool, cluster = MagicMock(), MagicMock()
+    agent_pool.name, cluster.name = "pool1", "cluster1"
+    update_agent_pool(container_service_client, agent_pool, cluster, "rg1")
+    container_service_client.agent_pools.create_or_update.assert_called_once_with(
+        resource_group_name="rg1", managed_cluster_name="cluster1", agent_pool_name="pool1", parameters=agent_pool,
+        polling=False)
+
+def test_update_agent_pool_to_0():
+    client = ContainerServiceClient(credentials=object(), subscription_id="123")
+    agent_pool = AgentPool(count=1, vm_size="Standard_D2s_v3")
+    agent_pool.name, cluster = "pool1", MagicMock()
+    cluster.name = "cluster1"
+    agent_pool.count -= 1
+    with pytest.raises(ValidationError):
+        client.agent_pools.create_or_update(resource_group_name="rg1", managed_cluster_name="cluster1",
+                                            agent_pool_name="pool1", parameters=agent_pool, polling=False)
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = "application/json"
+    response._content = json.dumps({"name": "pool1", "properties": {
+        "count": 1, "vmSize": "Standard_D2s_v3", "provisioningState": "Scaling"}}).encode()
+    cli_core = MagicMock()
+    cli_core.get_default_cli.return_value.invoke.return_value = 0
+    with patch.dict(sys.modules, {"azure.cli.core": cli_core}), \
+            patch.object(client._client, "send", return_value=response) as send:
+        assert update_agent_pool(client, agent_pool, cluster, "rg1").provisioning_state == "Scaling"
+    cli_core.get_default_cli.return_value.invoke.assert_called_once_with(
+        ["aks", "nodepool", "scale", "--resource-group", "rg1", "--cluster-name", "cluster1", "--name", "pool1",
+         "--node-count", "0", "--no-wait"])
+    assert send.call_args.args[0].method == "GET"
+    cli_core.get_default_cli.return_value.invoke.return_value = 1
+    with patch.dict(sys.modules, {"azure.cli.core": cli_core}), pytest.raises(RuntimeError):
+        update_agent_pool(client, agent_pool, cluster, "rg1")
+
+@pytest.fixture
+def config_params():
+    return Config(AGENT_POOL_NAME="pool1", AZURE_SUBSCRIPTION_ID="123", AZURE_RESOURCE_GROUP_NAME="rg1",
+                  AKS_CLUSTER_NAME="cluster1", DEFAULT_NAMESPACE="default", MAX_POD_QUEUE=0,
+                  DEFAULT_POD_PHASE="Pending")
+
+def test_config_down_scaling_strategy(config_params):
+    assert config_params.DEFAULT_DOWN_SCALING_STRATEGY is DownScalingStrategy.LATEST
+    config_params = dataclasses.replace(config_params, DEFAULT_DOWN_SCALING_STRATEGY="oldest")
+    assert config_params.DEFAULT_DOWN_SCALING_STRATEGY is DownScalingStrategy.OLDEST
+    with pytest.raises(ValueError):
+        dataclasses.replace(config_params, DEFAULT_DOWN_SCALING_STRATEGY="newest")
+
+def test_aks_scaler_waits_before_scaling_up(k8s_client, cache, config_params):
+    agent_pool = MagicMock(count=2, enable_auto_scaling=False, provisioning_state="Succeeded")
+    cache._apply_event(cache._pod_phases, _pod_phase, "ADDED",
+                       {"metadata": {"name": "pod1"}, "status": {"phase": "Pending"}})
+    last_scaling_event_time = datetime.now(tz=timezone.utc)
+    assert aks_scaler(k8s_client, cache, agent_pool, last_scaling_event_time, config_params) == last_scaling_event_time
+    assert agent_pool.count == 2
+    last_scaling_event_time -= timedelta(seconds=config_params.DELAY_BEFORE_SCALE_UP + 1)
+    assert aks_scaler(k8s_client, cache, agent_pool, last_scaling_event_time, config_params) > last_scaling_event_time
+    assert agent_pool.count == 3
+
+@pytest.mark.parametrize("strategy, node_to_remove", [("latest", "node3"), ("oldest", "node1")])
+def test_aks_scaler_scales_down(k8s_client, cache, config_params, strategy, node_to_remove):
+    config_params = dataclasses.replace(config_params, MAX_POD_QUEUE=1, DEFAULT_DOWN_SCALING_STRATEGY=strategy)
+    agent_pool = MagicMock(count=2, enable_auto_scaling=False, provisioning_state="Succeeded")
+    agent_pool.name = "pool1"
+    for node in ("node1", "node3"):
+        cache._apply_event(cache._node_pools, _node_agent_pool, "ADDED",
+                           {"metadata": {"name": node, "labels": {"agentpool": "pool1"}}})
+    last_scaling_event_time = datetime.now(tz=timezone.utc) - timedelta(
+        seconds=config_params.DELAY_BEFORE_SCALE_DOWN + 1)
+    with patch("scale.wait_for_pods_to_leave_node", return_value=[]):
+        aks_scaler(k8s_client, cache, agent_pool, last_scaling_event_time, config_params)
+    k8s_client.delete_node.assert_called_once_with(node_to_remove)
+    assert agent_pool.count == 1
+
+def test_aks_scaler_without_nodes(k8s_client, cache, config_params):
+    config_params = dataclasses.replace(config_params, MAX_POD_QUEUE=1)
+    agent_pool = MagicMock(count=0, enable_auto_scaling=False, provisioning_state="Succeeded")
+    last_scaling_event_time = datetime.now(tz=timezone.utc) - timedelta(
+        seconds=config_params.DELAY_BEFORE_SCALE_DOWN + 1)
+    assert aks_scaler(k8s_client, cache, agent_pool, last_scaling_event_time, config_params) == last_scaling_event_time
+    k8s_client.delete_node.assert_not_called()
+
+@pytest.fixture
+def agent_pool_sync(container_service_client, config_params):
+    container_service_client.agent_pools.get.side_effect = \
+        lambda **kwargs: MagicMock(count=2, provisioning_state="Succeeded")
+    cluster = MagicMock()
+    cluster.name = "cluster1"
+    return AgentPoolSync(container_service_client, cluster, config_params)
+
+def scale_pool(agent_pool_sync, delta, now):
+    agent_pool = agent_pool_sync.get()
+    agent_pool.count += delta
+    agent_pool_sync.flush(now=now)
+
+def test_agent_pool_sync_coalesces_updates(container_service_client, agent_pool_sync):
+    with patch("scale.update_agent_pool", side_effect=lambda agent_pool, **kwargs: agent_pool) as update:
+        scale_pool(agent_pool_sync, 1, now=0)
+        assert update.call_count == 1
+        scale_pool(agent_pool_sync, 1, now=1)
+        scale_pool(agent_pool_sync, 1, now=2)
+        scale_pool(agent_pool_sync, 0, now=3)
+        assert update.call_count == 1
+        assert agent_pool_sync.get().count == 5
+    container_service_client.agent_pools.get.assert_called_once()
+
+def test_agent_pool_sync_flushes_at_update_interval(agent_pool_sync):
+    with patch("scale.update_agent_pool", side_effect=lambda agent_pool, **kwargs: agent_pool) as update:
+        scale_pool(agent_pool_sync, 1, now=0)
+        scale_pool(agent_pool_sync, 1, now=4.9)
+        assert update.call_count == 1
+        scale_pool(agent_pool_sync, 0, now=5)
+        assert update.call_count == 2
+        assert update.call_args.kwargs["agent_pool"].count == 4
+        scale_pool(agent_pool_sync, 0, now=6)
+        assert update.call_count == 2
+
+def test_agent_pool_sync_retries_failed_update(agent_pool_sync):
+    with patch("scale.update_agent_pool", side_effect=[RuntimeError("update failed"), MagicMock(count=3)]) as update:
+        with pytest.raises(RuntimeError):
+            scale_pool(agent_pool_sync, 1, now=0)
+        agent_pool_sync.invalidate()
+        scale_pool(agent_pool_sync, 0, now=1)
+        assert update.call_count == 1
+        assert agent_pool_sync.get().count == 3
+        agent_pool_sync.flush(now=5)
+        assert update.call_count == 2
+        assert update.call_args.kwargs["agent_pool"].count == 3
+        scale_pool(agent_pool_sync, 0, now=10)
+        assert update.call_count == 2